@@ -0,0 +1,68 @@
+"""
+Annotation extraction for Ensembl VEP responses.
+
+This is the CPU-bound part of the annotator, kept in its own fully typed
+module so it can optionally be compiled to a C extension with mypyc (see
+setup.py). When no compiled build is present the pure-Python module is used.
+"""
+
+import sys
+from dataclasses import dataclass
+from typing import Any, Dict, List, Set
+
+
+@dataclass(slots=True)
+class Annotation:
+    """Annotations extracted for a single variant; empty strings when unavailable."""
+    start: str = ""
+    end: str = ""
+    most_severe_consequence: str = ""
+    gene_symbols: str = ""
+
+    def is_empty(self) -> bool:
+        """Return True if no annotation could be extracted."""
+        return not (self.start or self.end or self.most_severe_consequence or self.gene_symbols)
+
+
+def extract_annotations(api_response: Any) -> Annotation:
+    """Extract required annotations from the API response."""
+    # Check if we have a valid response. The parameter is deliberately Any: a
+    # List annotation would make mypyc reject anything else before this check.
+    if not api_response or not isinstance(api_response, list):
+        return Annotation()
+
+    # Just use the first variant as per requirements
+    variant: Dict[str, Any] = api_response[0]
+
+    # Extract gene symbols from transcript consequences
+    transcript_consequences: List[Dict[str, Any]] = variant.get("transcript_consequences") or []
+    gene_symbols: Set[Any] = {consequence.get("gene_symbol") for consequence in transcript_consequences}
+    gene_symbols.discard(None)
+    gene_symbols.discard("")
+
+    # Most variants hit one or two genes, so skip sorting when there is nothing to order
+    count = len(gene_symbols)
+    if count == 0:
+        symbols = ""
+    elif count == 1:
+        symbols = next(iter(gene_symbols))
+    else:
+        symbols = ",".join(sorted(gene_symbols))
+
+    # Consequence terms and gene symbols repeat across many variants; interning
+    # lets every annotation share one copy of each string
+    return Annotation(
+        start=str(variant.get("start", "")),
+        end=str(variant.get("end", "")),
+        most_severe_consequence=sys.intern(variant.get("most_severe_consequence") or ""),
+        gene_symbols=sys.intern(symbols)
+    )
+
+
+def extract_batch_annotations(rsids: List[str], variants: Dict[str, Any]) -> Dict[str, Annotation]:
+    """Extract annotations for a batch of RSIDs from their VEP variants, keyed by RSID."""
+    annotations = {}
+    for rsid in rsids:
+        variant = variants.get(rsid)
+        annotations[rsid] = extract_annotations([variant] if variant is not None else [])
+    return annotations
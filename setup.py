@@ -0,0 +1,17 @@
+"""
+Optional build script that compiles the annotation extraction module with mypyc.
+
+    pip install mypy
+    python setup.py build_ext --inplace
+
+The compiled extension is picked up automatically when present; otherwise the
+pure-Python extraction.py is used.
+"""
+
+from setuptools import setup
+from mypyc.build import mypycify
+
+setup(
+    name="variant-annotator",
+    ext_modules=mypycify(["extraction.py"]),
+)
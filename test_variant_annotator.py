@@ -3,15 +3,25 @@
 Unit tests for the variant annotation CLI tool.
 """
 
+import argparse
+import asyncio
 import os
+import sqlite3
 import tempfile
 import unittest
-from unittest.mock import patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 from variant_annotator import (
+    Annotation,
     read_rsids,
+    validate_arguments,
+    write_tsv,
     extract_annotations,
-    query_ensembl_api
+    extract_batch_annotations,
+    query_ensembl_batch,
+    annotate_rsids,
+    open_cache,
+    save_cached_variants
 )
 
 
@@ -34,6 +44,71 @@ class TestVariantAnnotator(unittest.TestCase):
             # Clean up the temp file when we're done
             os.unlink(tmp_filename)
 
+    def test_validate_arguments(self):
+        """Test that bad paths are rejected before any RSIDs are processed."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, "rsids.txt")
+            output_file = os.path.join(tmp_dir, "results", "out.tsv")
+            args = argparse.Namespace(input=input_file, output=output_file, force=False)
+            
+            # Missing input file
+            with patch("sys.stderr"), self.assertRaises(SystemExit):
+                validate_arguments(args)
+            
+            # Valid paths pass and the output directory is created up front
+            with open(input_file, "w") as f:
+                f.write("rs1\n")
+            validate_arguments(args)
+            self.assertTrue(os.path.isdir(os.path.dirname(output_file)))
+            
+            # Existing output file needs --force
+            with open(output_file, "w"):
+                pass
+            with patch("sys.stderr"), self.assertRaises(SystemExit):
+                validate_arguments(args)
+            args.force = True
+            validate_arguments(args)
+            
+            # A directory is reported as such rather than asking for --force
+            args.output = tmp_dir
+            args.force = False
+            with patch("sys.stderr") as mock_stderr, self.assertRaises(SystemExit):
+                validate_arguments(args)
+            written = "".join(c.args[0] for c in mock_stderr.write.call_args_list)
+            self.assertIn("is a directory", written)
+
+    def test_read_rsids_skips_invalid_lines(self):
+        """Test that malformed RSIDs are dropped while duplicates are kept."""
+        with tempfile.NamedTemporaryFile(mode='w', delete=False) as tmp:
+            tmp.write("rs12345\nRS1\nrs\nrs12a\n  rs67890  \nrs12345\n")
+            tmp_filename = tmp.name
+        
+        try:
+            with patch("sys.stderr"):
+                rsids = read_rsids(tmp_filename)
+            self.assertEqual(rsids, ["rs12345", "rs67890", "rs12345"])
+        finally:
+            os.unlink(tmp_filename)
+
+    def test_write_tsv_repeats_duplicate_rsids(self):
+        """Test that duplicate RSIDs get one output row each, in input order."""
+        annotations = {
+            "rs1": Annotation(start="1", end="1", most_severe_consequence="stop_gained", gene_symbols="A"),
+            "rs2": Annotation(),
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file = os.path.join(tmp_dir, "out.tsv")
+            write_tsv(annotations, output_file, ["rs1", "rs2", "rs1"])
+            with open(output_file) as f:
+                lines = f.read().splitlines()
+        
+        self.assertEqual(lines, [
+            "rsid\tstart\tend\tmost_severe_consequence\tgene_symbols",
+            "rs1\t1\t1\tstop_gained\tA",
+            "rs2\t\t\t\t",
+            "rs1\t1\t1\tstop_gained\tA",
+        ])
+
     def test_extract_annotations(self):
         """Test that we can extract annotations from API responses."""
         # This is what a response from the API might look like
@@ -54,32 +129,190 @@ class TestVariantAnnotator(unittest.TestCase):
         result = extract_annotations(sample_response)
         
         # Check that each field was extracted correctly
-        self.assertEqual(result["start"], "12345")
-        self.assertEqual(result["end"], "12346")
-        self.assertEqual(result["most_severe_consequence"], "missense_variant")
-        self.assertEqual(result["gene_symbols"], "GENE1,GENE2")  # Should be sorted and deduplicated
+        self.assertEqual(result.start, "12345")
+        self.assertEqual(result.end, "12346")
+        self.assertEqual(result.most_severe_consequence, "missense_variant")
+        self.assertEqual(result.gene_symbols, "GENE1,GENE2")  # Should be sorted and deduplicated
+        self.assertFalse(result.is_empty())
+        
+        # Empty or malformed responses give an empty annotation
+        self.assertTrue(extract_annotations([]).is_empty())
+        self.assertTrue(extract_annotations({}).is_empty())
+        self.assertTrue(extract_annotations(None).is_empty())
     
-    @patch("requests.get")
-    def test_query_ensembl_api(self, mock_get):
-        """Test that our API query function works correctly."""
-        # Set up a fake response for the mock
-        mock_response = unittest.mock.Mock()
-        mock_response.status_code = 200  # Set a status code
-        mock_response.json.return_value = [{"start": 12345, "end": 12346}]
-        mock_response.raise_for_status.return_value = None
-        mock_get.return_value = mock_response
-        
-        # Call our function with the mock in place
-        result = query_ensembl_api("rs12345")
-        
-        # Check we got the expected result
-        self.assertEqual(result, [{"start": 12345, "end": 12346}])
-        
-        # Verify the API was called with the right parameters
-        mock_get.assert_called_once_with(
-            "https://rest.ensembl.org/vep/human/id/rs12345",
-            headers={"Content-Type": "application/json", "Accept": "application/json"}
+    def test_extract_batch_annotations_shares_repeated_strings(self):
+        """Test that a single gene symbol is used as-is and repeated values share one string."""
+        # Build equal strings separately, as JSON parsing does for each variant
+        variants = {
+            rsid: {"most_severe_consequence": "".join(["missense", "_variant"]),
+                   "transcript_consequences": [{"gene_symbol": "".join(["GA", "TA2"])}]}
+            for rsid in ["rs1", "rs2"]
+        }
+        
+        annotations = extract_batch_annotations(["rs1", "rs2"], variants)
+        
+        self.assertEqual(annotations["rs1"].gene_symbols, "GATA2")
+        self.assertIs(annotations["rs1"].gene_symbols, annotations["rs2"].gene_symbols)
+        self.assertIs(annotations["rs1"].most_severe_consequence, annotations["rs2"].most_severe_consequence)
+    
+    def test_query_ensembl_batch(self):
+        """Test that a batch of RSIDs is sent in a single POST request."""
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.content = b'[{"input": "rs1"}, {"input": "rs2"}]'
+        mock_client = MagicMock()
+        mock_client.request = AsyncMock(return_value=mock_response)
+        
+        result = asyncio.run(query_ensembl_batch(mock_client, ["rs1", "rs2"]))
+        
+        self.assertEqual(result, [{"input": "rs1"}, {"input": "rs2"}])
+        mock_client.request.assert_awaited_once_with(
+            "POST",
+            "https://rest.ensembl.org/vep/human/id",
+            headers={"Content-Type": "application/json", "Accept": "application/json"},
+            content=b'{"ids":["rs1","rs2"]}'
         )
+    
+    @patch("variant_annotator.query_ensembl_batch", new_callable=AsyncMock)
+    def test_annotate_rsids_matches_batch_results_to_input(self, mock_batch):
+        """Test that batch results are matched back to RSIDs by their input ID."""
+        # Ensembl returns variants in its own order and leaves out unknown IDs
+        mock_batch.return_value = [
+            {"input": "rs2", "start": 2, "end": 2, "most_severe_consequence": "stop_gained"},
+            {"input": "rs1", "start": 1, "end": 1, "most_severe_consequence": "missense_variant"},
+            # A second location for rs1; only the first entry is used
+            {"input": "rs1", "start": 900, "end": 900, "most_severe_consequence": "intron_variant"},
+        ]
+        
+        with patch("builtins.print"), patch("variant_annotator.print_progress_bar"):
+            annotations = asyncio.run(annotate_rsids(["rs1", "rs2", "rs3"], "human"))
+        
+        self.assertEqual([annotations[rsid].start for rsid in ["rs1", "rs2", "rs3"]], ["1", "2", ""])
+        self.assertEqual(annotations["rs1"].most_severe_consequence, "missense_variant")
+        self.assertEqual(annotations["rs2"].most_severe_consequence, "stop_gained")
+    
+    @patch("variant_annotator.query_ensembl_batch", new_callable=AsyncMock)
+    def test_annotate_rsids_continues_when_cache_fails(self, mock_batch):
+        """Test that cache read and write errors are warnings, not fatal."""
+        mock_batch.return_value = [{"input": "rs1", "start": 1, "end": 1}]
+        broken_cache = MagicMock()
+        broken_cache.execute.side_effect = sqlite3.OperationalError("database is locked")
+        broken_cache.executemany.side_effect = sqlite3.OperationalError("attempt to write a readonly database")
+        
+        with patch("sys.stderr"), patch("variant_annotator.print_progress_bar"):
+            annotations = asyncio.run(annotate_rsids(["rs1", "rs2"], "human", cache=broken_cache))
+        
+        self.assertEqual(annotations["rs1"].start, "1")
+        self.assertTrue(annotations["rs2"].is_empty())
+        broken_cache.executemany.assert_called_once()
+    
+    def test_open_cache_evicts_expired_entries(self):
+        """Test that responses older than the expiry are deleted when the cache is opened."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_file = os.path.join(tmp_dir, "cache.sqlite")
+            cache = open_cache(cache_file)
+            save_cached_variants(cache, "human", {"rs1": {"input": "rs1"}, "rs2": {"input": "rs2"}})
+            with cache:
+                cache.execute("UPDATE responses SET created = 0 WHERE rsid = 'rs1'")
+            cache.close()
+            
+            cache = open_cache(cache_file)
+            try:
+                rows = cache.execute("SELECT rsid FROM responses").fetchall()
+            finally:
+                cache.close()
+        
+        self.assertEqual(rows, [("rs2",)])
+    
+    @patch("variant_annotator.query_ensembl_batch", new_callable=AsyncMock)
+    def test_annotate_rsids_skips_cached_rsids(self, mock_batch):
+        """Test that cached RSIDs are answered from disk and only misses hit the API."""
+        mock_batch.return_value = [{"input": "rs2", "start": 2, "end": 2}]
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = open_cache(os.path.join(tmp_dir, "cache.sqlite"))
+            try:
+                save_cached_variants(cache, "human", {"rs1": {"input": "rs1", "start": 1, "end": 1}})
+                with patch("builtins.print"), patch("variant_annotator.print_progress_bar"):
+                    annotations = asyncio.run(annotate_rsids(["rs1", "rs2"], "human", cache=cache))
+            finally:
+                cache.close()
+        
+        self.assertEqual(annotations["rs1"].start, "1")
+        self.assertEqual(annotations["rs2"].start, "2")
+        # Only the uncached RSID is queried
+        mock_batch.assert_awaited_once()
+        self.assertEqual(mock_batch.call_args.args[1], ["rs2"])
+    
+    @patch("variant_annotator.asyncio.sleep", new_callable=AsyncMock)
+    def test_query_ensembl_batch_retries_when_rate_limited(self, mock_sleep):
+        """Test that a 429 response waits for Retry-After and tries again."""
+        rate_limited = MagicMock()
+        rate_limited.status_code = 429
+        rate_limited.headers = {"Retry-After": "1.5"}
+        ok = MagicMock()
+        ok.status_code = 200
+        ok.content = b'[{"input": "rs1"}]'
+        mock_client = MagicMock()
+        mock_client.request = AsyncMock(side_effect=[rate_limited, ok])
+        
+        with patch("sys.stderr"):
+            result = asyncio.run(query_ensembl_batch(mock_client, ["rs1"]))
+        
+        self.assertEqual(result, [{"input": "rs1"}])
+        self.assertEqual(mock_client.request.await_count, 2)
+        mock_sleep.assert_awaited_once_with(1.5)
+    
+    @patch("variant_annotator.random.uniform", return_value=0)
+    @patch("variant_annotator.asyncio.sleep", new_callable=AsyncMock)
+    def test_query_ensembl_batch_handles_http_date_retry_after(self, mock_sleep, mock_uniform):
+        """Test that a Retry-After given as an HTTP-date falls back to the backoff delay."""
+        rate_limited = MagicMock()
+        rate_limited.status_code = 429
+        rate_limited.headers = {"Retry-After": "Wed, 21 Oct 2026 07:28:00 GMT"}
+        ok = MagicMock()
+        ok.status_code = 200
+        ok.content = b'[{"input": "rs1"}]'
+        mock_client = MagicMock()
+        mock_client.request = AsyncMock(side_effect=[rate_limited, ok])
+        
+        with patch("sys.stderr"):
+            result = asyncio.run(query_ensembl_batch(mock_client, ["rs1"]))
+        
+        self.assertEqual(result, [{"input": "rs1"}])
+        mock_sleep.assert_awaited_once_with(0.5)
+    
+    @patch("variant_annotator.random.uniform", return_value=0)
+    @patch("variant_annotator.asyncio.sleep", new_callable=AsyncMock)
+    def test_query_ensembl_batch_backs_off_on_server_errors(self, mock_sleep, mock_uniform):
+        """Test that server errors are retried with exponentially growing delays."""
+        server_error = MagicMock()
+        server_error.status_code = 503
+        mock_client = MagicMock()
+        mock_client.request = AsyncMock(return_value=server_error)
+        
+        with patch("sys.stderr"):
+            result = asyncio.run(query_ensembl_batch(mock_client, ["rs1"]))
+        
+        # Gives up with an empty result after three attempts
+        self.assertEqual(result, [])
+        self.assertEqual(mock_client.request.await_count, 3)
+        self.assertEqual([c.args[0] for c in mock_sleep.await_args_list], [0.5, 1.0])
+    
+    def test_query_ensembl_batch_waits_for_rate_limiter(self):
+        """Test that each request takes a token from the rate limiter first."""
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.content = b'[]'
+        mock_client = MagicMock()
+        mock_client.request = AsyncMock(return_value=mock_response)
+        mock_limiter = MagicMock()
+        mock_limiter.acquire = AsyncMock()
+        
+        asyncio.run(query_ensembl_batch(mock_client, ["rs1"], limiter=mock_limiter))
+        
+        mock_limiter.acquire.assert_awaited_once()
+        mock_client.request.assert_awaited_once()
         
     # TODO: Add more tests for error handling
 
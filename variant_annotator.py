@@ -7,13 +7,40 @@ For Bio301 Advanced Genomics Project.
 """
 
 import argparse
-import csv
+import asyncio
 import os
+import random
+import re
+import sqlite3
 import sys
 import time
-import requests
+import httpx
+from aiolimiter import AsyncLimiter
+import orjson
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, Iterator, List, Any, Optional, Tuple
+
+from extraction import Annotation, extract_annotations, extract_batch_annotations
+
+# dbSNP RSIDs are 'rs' followed by digits; matched against raw bytes from the input file
+RSID_PATTERN = re.compile(rb"rs[0-9]+")
+
+# Output columns, matching the fields of Annotation
+FIELDNAMES = ("rsid", "start", "end", "most_severe_consequence", "gene_symbols")
+
+# Ensembl allows 15 requests per second; stay just under it and keep a few requests in flight
+MAX_REQUESTS_PER_SECOND = 14
+MAX_CONCURRENT_REQUESTS = 8
+# Maximum number of IDs Ensembl accepts in a single VEP POST request
+BATCH_SIZE = 200
+# Retry delays grow as 0.5s, 1s, ... plus up to 0.25s of random jitter
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_BACKOFF_JITTER = 0.25
+# Connections held open to the Ensembl REST server; HTTP/2 multiplexes requests over each
+CONNECTION_POOL_SIZE = 10
+# VEP output only changes between Ensembl releases, so cached responses stay valid for a while
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "variant_annotator", "responses.sqlite")
+CACHE_EXPIRY = 30 * 24 * 60 * 60  # seconds
 
 
 def parse_arguments():
@@ -37,31 +64,81 @@ def parse_arguments():
         "--force", "-f", action="store_true",
         help="Overwrite output file if it exists"
     )
+    parser.add_argument(
+        "--cache-file", default=CACHE_FILE,
+        help=f"SQLite file used to cache API responses between runs (default: {CACHE_FILE})"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Always query the API instead of using cached responses"
+    )
     return parser.parse_args()
 
 
+def validate_arguments(args: argparse.Namespace):
+    """Check the input and output paths before doing any work, exiting on problems."""
+    if not os.path.isfile(args.input):
+        print(f"Error: Input file '{args.input}' does not exist.", file=sys.stderr)
+        sys.exit(1)
+    
+    # A directory can't be overwritten even with --force, so report that first
+    if os.path.isdir(args.output):
+        print(f"Error: Output path '{args.output}' is a directory.", file=sys.stderr)
+        sys.exit(1)
+    
+    # Check if output file exists
+    if os.path.exists(args.output) and not args.force:
+        print(f"Error: Output file '{args.output}' already exists. Use --force to overwrite.", file=sys.stderr)
+        sys.exit(1)
+    
+    # Make sure the results can actually be saved once all the API calls are done
+    output_dir = os.path.dirname(args.output) or "."
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+    except OSError as e:
+        print(f"Error: Cannot create output directory '{output_dir}': {e}", file=sys.stderr)
+        sys.exit(1)
+    if not os.access(output_dir, os.W_OK) or (os.path.exists(args.output) and not os.access(args.output, os.W_OK)):
+        print(f"Error: Output file '{args.output}' is not writable.", file=sys.stderr)
+        sys.exit(1)
+
+
 def read_rsids(input_file: str) -> List[str]:
-    """Read RSIDs from the input file."""
+    """Read RSIDs from the input file.
+    
+    Duplicates are kept so the output has one row per input line, but are
+    counted and reported since each RSID is only queried once.
+    """
     try:
-        with open(input_file, 'r') as f:
+        with open(input_file, 'rb') as f:
             rsids = []
-            invalid_count = 0
+            seen = set()
+            invalid_rsids = []
+            duplicate_count = 0
             
             for line in f:
-                rsid = line.strip()
-                if not rsid:
+                line = line.strip()
+                if not line:
                     continue
                 
                 # Basic validation - RSIDs start with 'rs' followed by numbers
-                if not rsid.startswith('rs') or not rsid[2:].isdigit():
-                    print(f"Warning: Skipping invalid RSID format: {rsid}", file=sys.stderr)
-                    invalid_count += 1
+                if not RSID_PATTERN.fullmatch(line):
+                    invalid_rsids.append(line)
                     continue
-                    
+                
+                rsid = line.decode('ascii')
+                if rsid in seen:
+                    duplicate_count += 1
+                else:
+                    seen.add(rsid)
                 rsids.append(rsid)
             
-            if invalid_count > 0:
-                print(f"Skipped {invalid_count} invalid RSIDs", file=sys.stderr)
+            if invalid_rsids:
+                examples = ", ".join(r.decode('utf-8', 'replace') for r in invalid_rsids[:5])
+                more = ", ..." if len(invalid_rsids) > 5 else ""
+                print(f"Skipped {len(invalid_rsids)} invalid RSIDs: {examples}{more}", file=sys.stderr)
+            if duplicate_count > 0:
+                print(f"Found {duplicate_count} duplicate RSIDs, each will only be queried once", file=sys.stderr)
                 
             return rsids
     except Exception as e:
@@ -69,95 +146,172 @@ def read_rsids(input_file: str) -> List[str]:
         sys.exit(1)
 
 
-def query_ensembl_api(rsid: str, species: str = "human") -> Any:
-    """Query the Ensembl VEP API for a given RSID."""
-    url = f"https://rest.ensembl.org/vep/{species}/id/{rsid}"
+def open_cache(cache_file: str) -> Optional[sqlite3.Connection]:
+    """Open (creating if needed) the on-disk API response cache, dropping expired entries."""
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        cache = sqlite3.connect(cache_file)
+        cache.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "species TEXT, rsid TEXT, response TEXT, created REAL, "
+            "PRIMARY KEY (species, rsid))"
+        )
+    except (OSError, sqlite3.Error) as e:
+        print(f"Warning: Could not open cache file, continuing without it: {e}", file=sys.stderr)
+        return None
+    
+    # Evict expired responses so the file doesn't keep growing with RSIDs never fetched again.
+    # A cache that can't be cleaned (e.g. read-only) is still usable for lookups.
+    try:
+        with cache:
+            cache.execute("DELETE FROM responses WHERE created < ?", (time.time() - CACHE_EXPIRY,))
+    except sqlite3.Error as e:
+        print(f"Warning: Could not remove expired cache entries: {e}", file=sys.stderr)
+    return cache
+
+
+def load_cached_variants(cache: sqlite3.Connection, species: str, rsids: List[str]) -> Iterator[Tuple[str, Any]]:
+    """Yield (rsid, variant) for each RSID with a previously fetched VEP variant.
+    
+    If the cache cannot be read, a warning is printed and the remaining RSIDs
+    are treated as cache misses.
+    """
+    oldest = time.time() - CACHE_EXPIRY
+    for rsid in rsids:
+        try:
+            row = cache.execute(
+                "SELECT response FROM responses WHERE species = ? AND rsid = ? AND created >= ?",
+                (species, rsid, oldest)
+            ).fetchone()
+            variant = orjson.loads(row[0]) if row else None
+        except (sqlite3.Error, orjson.JSONDecodeError) as e:
+            print(f"Warning: Could not read cache file, continuing without it: {e}", file=sys.stderr)
+            return
+        if variant is not None:
+            yield rsid, variant
+
+
+def save_cached_variants(cache: sqlite3.Connection, species: str, variants: Dict[str, Any]) -> bool:
+    """Store fetched VEP variants so later runs can skip the API call.
+    
+    Returns False, after printing a warning, if the cache could not be written.
+    """
+    now = time.time()
+    try:
+        with cache:
+            cache.executemany(
+                "INSERT OR REPLACE INTO responses (species, rsid, response, created) VALUES (?, ?, ?, ?)",
+                [(species, rsid, orjson.dumps(variant).decode(), now) for rsid, variant in variants.items()]
+            )
+    except sqlite3.Error as e:
+        print(f"Warning: Could not write cache file, continuing without it: {e}", file=sys.stderr)
+        return False
+    return True
+
+
+def create_client() -> httpx.AsyncClient:
+    """Create an HTTP/2 client that multiplexes requests over pooled connections."""
+    limits = httpx.Limits(
+        max_connections=CONNECTION_POOL_SIZE,
+        max_keepalive_connections=CONNECTION_POOL_SIZE
+    )
+    timeout = httpx.Timeout(30, connect=5)
+    return httpx.AsyncClient(http2=True, limits=limits, timeout=timeout)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Seconds to wait before retrying after the given (zero-based) failed attempt.
+    
+    The delay doubles with each attempt, and random jitter keeps concurrent
+    requests from retrying in lockstep.
+    """
+    return RETRY_BACKOFF_FACTOR * 2 ** attempt + random.uniform(0, RETRY_BACKOFF_JITTER)
+
+
+def retry_after_delay(response: httpx.Response, attempt: int) -> float:
+    """Seconds to wait after a 429, from the Retry-After header when it gives a number.
+    
+    Falls back to the usual backoff if the header is missing or is an HTTP-date.
+    """
+    try:
+        return max(0.0, float(response.headers["Retry-After"]))
+    except (KeyError, TypeError, ValueError):
+        return backoff_delay(attempt)
+
+
+async def fetch_json(client: httpx.AsyncClient, method: str, url: str, label: str,
+                     limiter: Optional[AsyncLimiter] = None, **kwargs) -> Any:
+    """Send a request to the Ensembl REST API, retrying on transient errors.
+    
+    Every attempt, including retries, waits for a token from the limiter if one
+    is given. Returns the decoded JSON body, or None if the request failed.
+    """
     headers = {
         "Content-Type": "application/json",
         "Accept": "application/json"
     }
     
     max_retries = 3
-    retry_delay = 2  # seconds
     
     for attempt in range(max_retries):
         try:
-            response = requests.get(url, headers=headers)
+            if limiter is not None:
+                await limiter.acquire()
+            response = await client.request(method, url, headers=headers, **kwargs)
             
             # Handle common error cases
             if response.status_code == 429:  # Rate limited
                 if attempt < max_retries - 1:
-                    print(f"Rate limited for {rsid}, retrying...", file=sys.stderr)
-                    time.sleep(retry_delay)
+                    retry_after = retry_after_delay(response, attempt)
+                    print(f"Rate limited for {label}, retrying in {retry_after}s...", file=sys.stderr)
+                    await asyncio.sleep(retry_after)
                     continue
             
             if response.status_code == 400:
-                print(f"Bad request for {rsid}: Invalid RSID", file=sys.stderr)
-                return {}
+                print(f"Bad request for {label}: Invalid RSID", file=sys.stderr)
+                return None
             elif response.status_code == 404:
-                print(f"Not found: {rsid} doesn't exist", file=sys.stderr)
-                return {}
+                print(f"Not found: {label} doesn't exist", file=sys.stderr)
+                return None
             elif response.status_code >= 500:
-                print(f"Server error for {rsid}", file=sys.stderr)
+                print(f"Server error for {label}", file=sys.stderr)
                 if attempt < max_retries - 1:
-                    time.sleep(retry_delay)
+                    await asyncio.sleep(backoff_delay(attempt))
                     continue
-                return {}
+                return None
             
             response.raise_for_status()
-            return response.json()
+            return orjson.loads(response.content)
         
-        except requests.exceptions.RequestException as e:
-            print(f"Error querying API for {rsid}: {e}", file=sys.stderr)
+        except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+            print(f"Error querying API for {label}: {e}", file=sys.stderr)
             if attempt < max_retries - 1:
-                time.sleep(retry_delay)
+                await asyncio.sleep(backoff_delay(attempt))
             else:
-                return {}
+                return None
 
 
-def extract_annotations(api_response: Any) -> Dict:
-    """Extract required annotations from the API response."""
-    annotation = {
-        "start": "",
-        "end": "",
-        "most_severe_consequence": "",
-        "gene_symbols": ""
-    }
-    
-    # Check if we have a valid response
-    if not api_response or not isinstance(api_response, list) or not api_response:
-        return annotation
-    
-    # Just use the first variant as per requirements
-    variant = api_response[0]
-    
-    # Extract basic fields
-    annotation["start"] = str(variant.get("start", ""))
-    annotation["end"] = str(variant.get("end", ""))
-    annotation["most_severe_consequence"] = variant.get("most_severe_consequence", "")
-    
-    # Extract gene symbols from transcript consequences
-    gene_symbols = set()
-    for consequence in variant.get("transcript_consequences", []):
-        gene_symbol = consequence.get("gene_symbol")
-        if gene_symbol:
-            gene_symbols.add(gene_symbol)
-    
-    annotation["gene_symbols"] = ",".join(sorted(gene_symbols))
-    return annotation
+async def query_ensembl_batch(client: httpx.AsyncClient, rsids: List[str], species: str = "human",
+                              limiter: Optional[AsyncLimiter] = None) -> List[Any]:
+    """Query the Ensembl VEP API for up to BATCH_SIZE RSIDs in one POST request."""
+    url = f"https://rest.ensembl.org/vep/{species}/id"
+    label = f"batch of {len(rsids)} RSIDs starting at {rsids[0]}"
+    result = await fetch_json(client, "POST", url, label, limiter=limiter, content=orjson.dumps({"ids": rsids}))
+    return result if isinstance(result, list) else []
 
 
-def write_tsv(annotations: List[Dict], output_file: str, rsids: List[str]):
-    """Write annotations to a TSV file."""
+def write_tsv(annotations: Dict[str, Annotation], output_file: str, rsids: List[str]):
+    """Write annotations to a TSV file, one row per RSID in input order."""
+    # Values are positions, ontology terms and gene symbols, which never contain
+    # tabs or newlines, so rows can be joined directly without csv quoting
     try:
-        with open(output_file, 'w', newline='') as f:
-            fieldnames = ["rsid", "start", "end", "most_severe_consequence", "gene_symbols"]
-            writer = csv.DictWriter(f, fieldnames=fieldnames, delimiter='\t')
-            
-            writer.writeheader()
-            for rsid, annotation in zip(rsids, annotations):
-                row = {"rsid": rsid, **annotation}
-                writer.writerow(row)
+        with open(output_file, 'w', buffering=1 << 20) as f:
+            f.write("\t".join(FIELDNAMES) + "\n")
+            for rsid in rsids:
+                a = annotations[rsid]
+                f.write(f"{rsid}\t{a.start}\t{a.end}\t{a.most_severe_consequence}\t{a.gene_symbols}\n")
     except Exception as e:
         print(f"Error writing to output file: {e}", file=sys.stderr)
         sys.exit(1)
@@ -173,15 +327,72 @@ def print_progress_bar(current, total, bar_length=50):
     sys.stdout.flush()
 
 
+async def annotate_rsids(rsids: List[str], species: str, verbose: bool = False,
+                         cache: Optional[sqlite3.Connection] = None) -> Dict[str, Annotation]:
+    """Fetch and extract annotations for a list of unique RSIDs, keyed by RSID.
+    
+    Responses are reduced to annotations as soon as they arrive, so only the
+    batches currently in flight are held in memory as raw JSON.
+    """
+    annotations = {}
+    
+    cached_rsids = set()
+    if cache is not None:
+        cached = {}
+        for rsid, variant in load_cached_variants(cache, species, rsids):
+            cached_rsids.add(rsid)
+            cached[rsid] = variant
+            if len(cached) == BATCH_SIZE:
+                annotations.update(extract_batch_annotations(list(cached), cached))
+                cached = {}
+        if cached:
+            annotations.update(extract_batch_annotations(list(cached), cached))
+    to_query = [rsid for rsid in rsids if rsid not in cached_rsids]
+    if verbose and cached_rsids:
+        print(f"Using cached responses for {len(cached_rsids)} RSIDs")
+    
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = AsyncLimiter(MAX_REQUESTS_PER_SECOND, time_period=1.0)
+    chunks = [to_query[i:i + BATCH_SIZE] for i in range(0, len(to_query), BATCH_SIZE)]
+    total = len(to_query)
+    completed = 0
+    shown_percent = -1
+    
+    async def fetch_chunk(client: httpx.AsyncClient, chunk: List[str]):
+        nonlocal cache, completed, shown_percent
+        async with semaphore:
+            variants = await query_ensembl_batch(client, chunk, species=species, limiter=limiter)
+        
+        completed += len(chunk)
+        if verbose:
+            print(f"Processed {len(chunk)} RSIDs ({completed}/{total})")
+        elif completed * 100 // total != shown_percent:
+            # Only redraw when the percentage moves, to keep terminal writes off the hot path
+            shown_percent = completed * 100 // total
+            print_progress_bar(completed, total)
+        
+        # The batch response only lists variants Ensembl could resolve, keyed by input ID.
+        # An RSID mapping to several locations has several entries; keep the first one.
+        fetched = {}
+        for variant in variants:
+            fetched.setdefault(variant.get("input"), variant)
+        if cache is not None and fetched and not save_cached_variants(cache, species, fetched):
+            # Stop trying after the first failure rather than warning for every batch
+            cache = None
+        annotations.update(extract_batch_annotations(chunk, fetched))
+    
+    if chunks:
+        async with create_client() as client:
+            await asyncio.gather(*(fetch_chunk(client, chunk) for chunk in chunks))
+    
+    return annotations
+
+
 def main():
     """Main entry point for the CLI."""
     start_time = datetime.now()
     args = parse_arguments()
-    
-    # Check if output file exists
-    if os.path.exists(args.output) and not args.force:
-        print(f"Error: Output file '{args.output}' already exists. Use --force to overwrite.", file=sys.stderr)
-        sys.exit(1)
+    validate_arguments(args)
     
     # Read RSIDs from input file
     rsids = read_rsids(args.input)
@@ -189,35 +400,24 @@ def main():
         print("No valid RSIDs found in input file. Exiting.", file=sys.stderr)
         sys.exit(1)
         
-    print(f"Processing {len(rsids)} RSIDs...")
-    
-    # Process each RSID
-    annotations = []
-    success_count = 0
-    failed_count = 0
-    
-    for idx, rsid in enumerate(rsids):
-        if args.verbose:
-            print(f"Processing {rsid} ({idx + 1}/{len(rsids)})")
-        else:
-            print_progress_bar(idx + 1, len(rsids))
-        
-        # Get annotation from API
-        api_response = query_ensembl_api(rsid, species=args.species)
-        annotation = extract_annotations(api_response)
-        annotations.append(annotation)
-        
-        # Count successes and failures
-        if any(annotation.values()):
-            success_count += 1
-        else:
-            failed_count += 1
-        
-        # Add a small delay to avoid overloading the API
-        time.sleep(0.1)
+    # Each RSID only needs to be looked up once, however often it is listed. Querying in
+    # numeric order keeps neighbouring IDs in the same batch; the output keeps input order.
+    unique_rsids = sorted(dict.fromkeys(rsids), key=lambda rsid: int(rsid[2:]))
+    print(f"Processing {len(unique_rsids)} unique RSIDs...")
     
+    # Query the API concurrently for all RSIDs not already cached
+    cache = None if args.no_cache else open_cache(args.cache_file)
+    try:
+        annotations = asyncio.run(annotate_rsids(unique_rsids, args.species, args.verbose, cache))
+    finally:
+        if cache is not None:
+            cache.close()
     print()  # New line after progress bar
     
+    # Count successes and failures
+    success_count = sum(1 for rsid in rsids if not annotations[rsid].is_empty())
+    failed_count = len(rsids) - success_count
+    
     # Write annotations to TSV file
     write_tsv(annotations, args.output, rsids)
     